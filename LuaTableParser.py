@@ -11,18 +11,39 @@
         expr  ::= 'nil' | boolean | number | luastring | table
         fieldsep  ::= ',' | ';'
 
-    There are 3 class definitions in this file:
-        Utils :          include utility methods used by other two classes
+    There are 9 class definitions in this file:
+        Utils :          include utility methods used by other classes
         LuaTableReader : read tables form a string;
                          do syntax checking and preliminary parsing
         LuaTableParser : include interfaces for clients of this parser;
                          the generic load() method loads and parses a lua table
                          from a string, the dump() method dumps a lua table from
                          the internal representation to a string
+        LuaDict, LuaList : tables which cache their dumped text until changed
+        LuaStringPool :  share identical keys and strings between loads
+        LuaRecordSchema :  describe the fields of homogeneous record tables
+        LuaRecordDecoder : parse record tables straight into record objects;
+                           created by LuaTableParser.compileSchema()
+        LuaTableIndex :  look up fields or tables of a large file by offset
 '''
 
+import array
+import collections
+import json
+import marshal
+import mmap
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class Utils:
+    # marks a record field which has no default value
+    MISSING = object()
+
     @staticmethod
     # convert a string to an integer or a floating point number
     def str_to_num(s):
@@ -39,6 +60,51 @@ class Utils:
         else:
             return i
 
+    @staticmethod
+    # make v a table tracked as a child of parent (None for a root table);
+    # v itself is used if it is a tracked table without a parent, a tracked
+    # copy of v is made if it is any other dict or list
+    def track(v, parent):
+        if isinstance(v, (LuaDict, LuaList)) and v.parent is None:
+            v.parent = parent
+            return v
+        elif isinstance(v, dict):
+            v = LuaDict(v)
+            v.parent = parent
+        elif isinstance(v, list):
+            v = LuaList(v)
+            v.parent = parent
+        return v
+
+    @staticmethod
+    # create a class with __slots__ for records with the given field names
+    def make_record_class(name, names):
+        names = tuple(names)
+
+        def __init__(self, *args):
+            for k, v in zip(names, args):
+                setattr(self, k, v)
+
+        def __repr__(self):
+            return name + '(' + ', '.join(
+                [k + '=' + repr(getattr(self, k)) for k in names]) + ')'
+
+        def __eq__(self, other):
+            if type(other) is not type(self):
+                return False
+            for k in names:
+                if getattr(self, k) != getattr(other, k):
+                    return False
+            return True
+
+        def __ne__(self, other):
+            return not __eq__(self, other)
+
+        return type(name, (object,), {'__slots__': names, '_fields': names,
+                                      '__init__': __init__,
+                                      '__repr__': __repr__,
+                                      '__eq__': __eq__, '__ne__': __ne__})
+
 
 class LuaTableReader:
     def __init__(self, s):
@@ -71,6 +137,14 @@ class LuaTableReader:
         self.__prevp = prevp
         return self.__next()
 
+    # get or set the position of the reader in the text
+    def tell(self):
+        return self.__index
+
+    def seek(self, index):
+        self.__index = index
+        self.__prevp = -1
+
     # back up one char
     def back(self):
         if self.__prevp != -1:
@@ -108,6 +182,198 @@ class LuaTableReader:
         table += '}'
         return table, fields
 
+    # get the events of the next Lua table, without building its contents:
+    #     ('start_table',), ('end_table',), ('key', raw),
+    #     ('value', type, raw) and ('comment', text)
+    # raw is the text of a key or value as it appears in the source, type is
+    # 'nil', 'boolean', 'number' or 'string'; as in load(), names used as
+    # values (the x in {x}) are nil, except those taken for numbers, like
+    # inf and nan. Keys and values are not evaluated.
+    # if raw is False, no text is sliced and raw is always None
+    # if comments is False, comments are skipped without being reported,
+    # otherwise they are reported before the event that follows them
+    def next_events(self, raw=True, comments=True):
+        pending = None
+        if comments:
+            pending = []
+        c = self.__next_clean_into(pending)
+        if pending:
+            for text in pending:
+                yield ('comment', text)
+            del pending[:]
+        if c != '{':
+            raise Exception('a table must start with \'{\'')
+        yield ('start_table',)
+        depth, state = 1, self.__FIELD
+        while True:
+            c = self.__next_clean_into(pending)
+            if pending:
+                for text in pending:
+                    yield ('comment', text)
+                del pending[:]
+            if c is None:
+                raise Exception('a table must end with \'}\'')
+            elif c == '}' and state != self.__VALUE:
+                yield ('end_table',)
+                depth -= 1
+                if depth == 0:
+                    return
+                state = self.__SEP
+                continue
+
+            if state == self.__SEP:
+                if c not in ',;':
+                    raise Exception('expected a \',\' \';\' or \'}\'')
+                state = self.__FIELD
+                continue
+
+            if state == self.__FIELD:
+                if c == '[':
+                    self.__backward()
+                    start = self.__index
+                    if self.__skip_xstring():  # a string in the array part
+                        yield ('value', 'string',
+                               raw and self.__text[start:self.__index] or None)
+                        state = self.__SEP
+                        continue
+                    self.__forward()
+                    key = self.__next_raw_index(raw, pending)
+                    if self.__next_clean_into(pending) != ']' \
+                            or self.__next_clean_into(pending) != '=':
+                        raise Exception('invalid table field')
+                    yield ('key', key)
+                    state = self.__VALUE
+                    continue
+                elif c.isalpha() or c == '_':
+                    self.__backward()
+                    token = self.__next_token()
+                    end, n = self.__index, len(pending or ())
+                    if self.__next_clean_into(pending) == '=':
+                        yield ('key', raw and token or None)
+                        state = self.__VALUE
+                    else:
+                        # stop right after the token, as for other values;
+                        # the comments after it are read again later
+                        self.seek(end)
+                        if pending is not None:
+                            del pending[n:]
+                        yield ('value', self.__token_type(token),
+                               raw and token or None)
+                        state = self.__SEP
+                    continue
+                # an expression in the array part
+                state = self.__VALUE
+
+            # state == self.__VALUE
+            if c == '{':
+                yield ('start_table',)
+                depth += 1
+                state = self.__FIELD
+                continue
+            self.__backward()
+            start = self.__index
+            if c in '\'\"':
+                self.__skip_string()
+                typ = 'string'
+            elif c.isdigit() or c in '+-.':
+                typ = self.__number_type(self.__next_number())
+            elif c.isalpha() or c == '_':
+                typ = self.__token_type(self.__next_token())
+            elif c == '[':
+                if not self.__skip_xstring():
+                    raise Exception('syntax error near \'[\'')
+                typ = 'string'
+            else:
+                raise Exception('syntax error near \'' + c + '\'')
+            yield ('value', typ, raw and self.__text[start:self.__index] or None)
+            state = self.__SEP
+
+    # states of next_events()
+    __FIELD, __VALUE, __SEP = range(3)
+
+    # like next_clean(), but append the text of skipped comments to comments
+    # unless it is None
+    def __next_clean_into(self, comments):
+        if comments is None:
+            return self.next_clean()
+        self.__swallow_spaces()
+        prevp = self.__index
+        while self.__try_swallow_comments():
+            comments.append(self.__text[prevp:self.__index].rstrip('\r\n'))
+            self.__swallow_spaces()
+            prevp = self.__index
+        self.__prevp = prevp
+        return self.__next()
+
+    # read the index between '[' and ']' for next_events()
+    def __next_raw_index(self, raw, comments):
+        c = self.__next_clean_into(comments)
+        if c is None:
+            raise Exception('invalid table field')
+        self.__backward()
+        start = self.__index
+        if c in '\'\"':
+            self.__skip_string()
+        elif c.isdigit() or c in '+-.':
+            index = self.__next_number()
+            if self.__number_type(index) == 'nil':  # e.g. a bare '-'
+                raise Exception('invalid table index : ' + index)
+        elif c != '[' or not self.__skip_xstring():
+            raise Exception('invalid table index near \'' + c + '\'')
+        if raw:
+            return self.__text[start:self.__index]
+        return None
+
+    def __token_type(self, token):
+        if token == 'true' or token == 'false':
+            return 'boolean'
+        elif token == 'nil':
+            return 'nil'
+        return self.__number_type(token)
+
+    # the type of a name or a number text: nil unless load() takes it for a
+    # number, like inf, or unlike a bare '-'
+    def __number_type(self, text):
+        try:
+            Utils.str_to_num(text)
+        except:
+            return 'nil'
+        else:
+            return 'number'
+
+    # skip a string delimited by ' or ", without evaluating it
+    def __skip_string(self):
+        mark = self.__next()
+        i = self.__index
+        while True:
+            j = self.__text.find(mark, i)
+            if j == -1:
+                raise Exception('a string must end with \' or \"')
+            k = self.__text.find('\\', i, j)
+            if k == -1:
+                self.__index = j + 1
+                return
+            i = k + 2  # skip the escaped char
+
+    # skip a xstring, without evaluating it
+    # this method has the 'commit or rollback' semantics
+    def __skip_xstring(self):
+        index = self.__index
+        self.__next()  # assert c == '['
+        c = self.__next()
+        cnt = 0
+        while c == '=':
+            cnt += 1
+            c = self.__next()
+        if c != '[':
+            self.__index = index
+            return False
+        j = self.__text.find(']' + '=' * cnt + ']', self.__index)
+        if j == -1:
+            raise Exception('invalid lua xstring')
+        self.__index = j + cnt + 2
+        return True
+
     # get the next field, where
     #     field ::= '[' expr1 ']' '=' expr2 | expr1 '=' expr2 | expr2
     # @return field : a string, the text representation of the field
@@ -422,12 +688,25 @@ class LuaTableReader:
 
 # LuaTableParser instances can be used by clients to parse or dump lua tables
 class LuaTableParser:
-    def __init__(self):
+    # the number of record shapes remembered by the dumper, and the number
+    # of keys above which a dict is not taken for a record
+    SHAPE_CACHE_SIZE = 256
+    SHAPE_MAX_KEYS = 64
+
+    # pool : an optional LuaStringPool; if given, identical keys (and
+    #        short string values, see LuaStringPool) share one object
+    # tracking : if True, tables are loaded as LuaDict and LuaList objects,
+    #            which remember their dumped text until they are changed,
+    #            so dump() only regenerates the changed parts
+    def __init__(self, pool=None, tracking=False):
         self.__table = {}
+        self.__shapes = collections.OrderedDict()
+        self.__pool = pool
+        self.__tracking = tracking
 
     # load a lua table from a string
     def load(self, s):
-        self.__table = self.__parse(s)
+        self.__table = self.__load(s)
 
     # dump the contents of the instance as lua table to a string
     def dump(self):
@@ -455,7 +734,7 @@ class LuaTableParser:
 
     # dump the internal data to a dict
     def dumpDict(self):
-        tmp = self.__parse(self.dump())
+        tmp = self.__load(self.dump())
         if isinstance(tmp, list):
             ret = {}
             n = len(tmp)
@@ -465,6 +744,404 @@ class LuaTableParser:
             return ret
         return tmp
 
+    # parse the first table in s into events, see
+    # LuaTableReader.next_events(); without a handler, a generator of the
+    # events is returned, otherwise the start_table(), end_table(),
+    # key(raw), value(type, raw) and comment(text) methods of the handler
+    # are called for each event. Methods the handler does not define are
+    # skipped, and raw text is only sliced if it defines key() or value()
+    def parseEvents(self, s, handler=None):
+        reader = LuaTableReader(s)
+        if handler is None:
+            return reader.next_events()
+        methods = {}
+        for name in ('start_table', 'end_table', 'key', 'value', 'comment'):
+            if hasattr(handler, name):
+                methods[name] = getattr(handler, name)
+        raw = 'key' in methods or 'value' in methods
+        for event in reader.next_events(raw, 'comment' in methods):
+            method = methods.get(event[0])
+            if method is not None:
+                method(*event[1:])
+
+    # load the array part of a table of homogeneous records, such as
+    # {{x=0, y=0}, {x=-10, y=1}}, into one column per field, without
+    # building a dict per record; named fields of the outer table are
+    # ignored, nil elements become rows where every field is missing
+    # @return columns, valid : dicts from field names to columns and to
+    #         validity masks, array('B') of 1 or 0 for nil or missing values
+    #         int and float fields become array('l') and array('d') columns,
+    #         or NumPy arrays if use_numpy is True and NumPy is available;
+    #         other fields become lists. Missing values are 0 or None.
+    #         Fields mixing ints and floats become array('d') columns, unless
+    #         an int is too large to be exact as a float; such fields, like
+    #         those with ints too large for array('l'), become lists.
+    def loadColumns(self, s, use_numpy=False):
+        return self.__pooled(self.__load_columns, s, use_numpy)
+
+    def __load_columns(self, s, use_numpy):
+        columns, rows = {}, 0
+        depth, skip, key = 0, 0, None
+        for event in LuaTableReader(s).next_events(True, False):
+            kind = event[0]
+            if kind == 'start_table':
+                depth += 1
+                if skip or depth == 1:
+                    continue
+                elif depth == 2 and key is not None:
+                    skip, key = depth, None  # a named field of the outer table
+                elif depth > 2:
+                    raise Exception('nested tables are not supported in '
+                                    + 'columnar records')
+            elif kind == 'end_table':
+                depth -= 1
+                if skip:
+                    if depth < skip:
+                        skip = 0
+                elif depth == 1:  # the end of a record
+                    rows += 1
+                    for column in columns.values():
+                        self.__pad_column(column, rows)
+            elif skip:
+                continue
+            elif kind == 'key':
+                key = event[1]
+            elif depth == 1:  # a value in the outer table
+                if key is None:
+                    if event[1] != 'nil':
+                        raise Exception('a record must be a table, got '
+                                        + event[2])
+                    rows += 1
+                    for column in columns.values():
+                        self.__pad_column(column, rows)
+                key = None
+            else:  # a value in a record
+                if key is None:
+                    raise Exception('positional fields are not supported in '
+                                    + 'columnar records')
+                v = self.__eval_raw_value(event[1], event[2])
+                if v is not None:
+                    k = self.__eval_raw_key(key)
+                    column = columns.get(k)
+                    if column is None:
+                        column = columns[k] = [None, array.array('B')]
+                        self.__pad_column(column, rows)
+                    self.__put_column(column, v, rows)
+                key = None
+
+        ret, valid = {}, {}
+        for k, (data, mask) in columns.items():
+            if data is None:
+                data = [None] * len(mask)
+            if use_numpy and numpy is not None:
+                if isinstance(data, array.array):
+                    data = numpy.frombuffer(data, dtype=data.typecode)
+                mask = numpy.frombuffer(mask, dtype=numpy.uint8).astype(bool)
+            ret[k], valid[k] = data, mask
+        return ret, valid
+
+    # the largest magnitude up to which every int is exact as a float
+    __MAX_EXACT_INT = 2 ** 53
+
+    # pad a column [data, mask] with missing values to n rows
+    def __pad_column(self, column, n):
+        data, mask = column
+        m = n - len(mask)
+        if m <= 0:
+            return
+        mask.extend([0] * m)
+        if isinstance(data, list):
+            data.extend([None] * m)
+        elif data is not None:
+            data.extend([0] * m)
+
+    # put v into the column [data, mask] as the value of the given row,
+    # changing the type of the column if v does not fit in it
+    def __put_column(self, column, v, row):
+        data, mask = column
+        if len(mask) > row:  # a duplicated key, the last value wins
+            data.pop()
+            mask.pop()
+        if isinstance(v, (bool, str)):
+            typecode = None
+        elif isinstance(v, float):
+            typecode = 'd'
+        else:
+            typecode = 'l'
+
+        if data is None:  # all values so far are missing
+            if typecode is None:
+                data = [None] * row
+            else:
+                data = array.array(typecode, [0] * row)
+        elif isinstance(data, array.array):
+            if typecode is None:
+                data = self.__column_to_list(data, mask)
+            elif typecode == 'd' and data.typecode == 'l':
+                if len(data) > 0 and (max(data) > self.__MAX_EXACT_INT
+                                      or min(data) < -self.__MAX_EXACT_INT):
+                    data = self.__column_to_list(data, mask)
+                else:
+                    data = array.array('d', data)
+            elif data.typecode == 'd' and abs(v) > self.__MAX_EXACT_INT:
+                data = self.__column_to_list(data, mask)
+        try:
+            data.append(v)
+        except OverflowError:  # an integer too large for array('l')
+            data = self.__column_to_list(data, mask)
+            data.append(v)
+        mask.append(1)
+        column[0] = data
+
+    def __column_to_list(self, data, mask):
+        ret = list(data)
+        for i in range(len(ret)):
+            if not mask[i]:
+                ret[i] = None
+        return ret
+
+    # evaluate the raw text of a key reported by LuaTableReader.next_events()
+    def __eval_raw_key(self, raw):
+        if raw[0] not in '\'\"[':  # a name or a number
+            if not (raw[0].isalpha() or raw[0] == '_') \
+                    or raw.lower() in ('inf', 'infinity', 'nan'):
+                return self.__eval_index(raw)
+            key = raw  # a name which float() does not take for a number
+        else:
+            key = self.__eval_raw_string(raw)
+        if self.__pool is not None:
+            return self.__pool.intern(key)
+        return key
+
+    # evaluate the raw text of a value reported by
+    # LuaTableReader.next_events()
+    def __eval_raw_value(self, typ, raw):
+        if typ == 'number':
+            try:
+                return Utils.str_to_num(raw)
+            except:  # nil, as in __eval_expr()
+                return None
+        elif typ == 'string':
+            x = self.__eval_raw_string(raw)
+            if self.__pool is not None \
+                    and len(x) <= self.__pool.max_value_length:
+                return self.__pool.intern(x)
+            return x
+        elif typ == 'boolean':
+            return raw == 'true'
+        return None
+
+    def __eval_raw_string(self, raw):
+        if raw[0] == '[':  # the contents of a xstring are not escaped
+            n = raw.index('[', 1) + 1
+            return raw[n:len(raw)-n]
+        return self.__eval_string(raw[1:len(raw)-1])
+
+    # write the first table in s to out, which may be any object with a
+    # write() method, as the JSON text json.dump() would write for the loaded
+    # table, without building the table. Keys are coerced and nil fields are
+    # dropped as in load(), and a table is written as an object if it has
+    # named fields which are not nil, its array part keyed by "1", "2", ...
+    # As this needs to be known before the first field of a table is written,
+    # s is scanned twice: first to classify the tables, at one byte for each,
+    # and to find the fields whose key is repeated, then to write the JSON
+    # text in chunks.
+    def transcodeJSON(self, s, out):
+        self.__pooled(self.__transcode_json, s, out)
+
+    def __transcode_json(self, s, out):
+        kinds, dropped, renamed = self.__classify_tables(s)
+        chunks, size, n, m = [], 0, 0, 0
+        opened, key = [], None  # [is_object, is_empty, array_index, table]
+        drop, skip = False, 0  # skip is the depth in a dropped table
+        for event in LuaTableReader(s).next_events(True, False):
+            kind = event[0]
+            if skip or drop:
+                drop = False
+                if kind == 'start_table':
+                    n += 1
+                    skip += 1
+                elif kind == 'end_table':
+                    skip -= 1
+                elif kind == 'key':
+                    m += 1
+                continue
+            if kind == 'key':
+                key = event[1]
+                m += 1
+                if m in dropped:
+                    key, drop = None, True
+                continue
+            elif kind == 'end_table':
+                chunk = opened.pop()[0] and '}' or ']'
+            else:
+                if kind == 'start_table':
+                    table = n
+                    is_object = kinds[n] == 1
+                    n += 1
+                    chunk = is_object and '{' or '['
+                else:
+                    chunk = self.__json_value(event[1], event[2])
+                if opened:
+                    top = opened[-1]
+                    if key is None:
+                        top[2] += 1
+                    if chunk is None:
+                        if top[0] or key is not None:
+                            key = None
+                            continue  # a nil field is dropped
+                        chunk = 'null'
+                    prefix = ''
+                    if top[1]:
+                        top[1] = False
+                    else:
+                        prefix = ', '
+                    if top[0] and key is None:
+                        name = renamed.get((top[3], top[2]))
+                        if name is None:
+                            name = '"' + str(top[2]) + '"'
+                        prefix += name + ': '
+                    elif top[0]:
+                        name = renamed.get(m)
+                        if name is None:
+                            name = self.__json_key(key)
+                        prefix += name + ': '
+                    chunk = prefix + chunk
+                    key = None
+                if kind == 'start_table':
+                    opened.append([is_object, True, 0, table])
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= 65536:
+                out.write(''.join(chunks))
+                chunks, size = [], 0
+        out.write(''.join(chunks))
+
+    # the first pass of transcodeJSON()
+    # a repeated key keeps the value of its last named field, so the others
+    # are dropped. Numeric keys which are equal, like 1 and 1.0, are the same
+    # key too: the dict keeps the first key and takes the value of the last
+    # named field, or of the array part as in __merge_result(). For each such
+    # group of named fields, all but the one written are dropped, and the one
+    # written is renamed to the first key.
+    # @return kinds : a bytearray with one byte for each table in the order
+    #                 they start, 1 for tables written as objects
+    #         dropped : a set of the ordinals of the named fields not written
+    #         renamed : a dict from the ordinals of named fields, or from
+    #                   (table, array_index) of array items, to JSON keys
+    def __classify_tables(self, s):
+        kinds, dropped, renamed = bytearray(), set(), {}
+        # [table, array_index, nils, num_keys, other_keys]
+        opened, key, m = [], None, 0
+        for event in LuaTableReader(s).next_events(True, False):
+            kind = event[0]
+            if kind == 'key':
+                key = event[1]
+                m += 1
+                continue
+            elif kind == 'end_table':
+                table, n, nils, num_keys, _ = opened.pop()
+                if num_keys is not None and kinds[table] == 1:
+                    for k, (raw, ordinals) in num_keys.items():
+                        name = self.__json_key(raw)
+                        if 1 <= k <= n and (nils is None or k not in nils):
+                            dropped.update(ordinals)
+                            renamed[(table, int(k))] = name
+                        else:
+                            dropped.update(ordinals[:-1])
+                            renamed[ordinals[-1]] = name
+            elif opened:
+                top = opened[-1]
+                nil = kind == 'value' and event[1] == 'nil'
+                if key is None:
+                    top[1] += 1
+                    if nil:
+                        if top[2] is None:
+                            top[2] = set()
+                        top[2].add(top[1])
+                elif not nil:
+                    kinds[top[0]] = 1
+                    k = self.__eval_raw_key(key)
+                    if isinstance(k, (int, long)) or (isinstance(k, float)
+                                                      and k.is_integer()):
+                        if top[3] is None:
+                            top[3] = {}
+                        # the first key equal to k stays in the dict
+                        top[3].setdefault(k, (key, []))[1].append(m)
+                    else:
+                        if top[4] is None:
+                            top[4] = {}
+                        last = top[4].get(k)
+                        if last is not None:
+                            dropped.add(last)
+                        top[4][k] = m
+            if kind == 'start_table':
+                opened.append([len(kinds), 0, None, None, None])
+                kinds.append(0)
+            key = None
+        return kinds, dropped, renamed
+
+    # transcode a lua table in the text file p to JSON in the file q, see
+    # transcodeJSON(); p is mapped into memory instead of being read
+    def transcodeLuaTable(self, p, q):
+        f = open(p, 'rb')
+        text = ''
+        if os.fstat(f.fileno()).st_size > 0:
+            text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        g = open(q, 'w')
+        try:
+            self.transcodeJSON(text, g)
+        finally:
+            g.close()
+            if isinstance(text, mmap.mmap):
+                text.close()
+            f.close()
+
+    # get the JSON text of the raw key of an object, see __eval_raw_key()
+    def __json_key(self, raw):
+        k = self.__eval_raw_key(raw)
+        if isinstance(k, str):
+            return json.encoder.encode_basestring_ascii(k)
+        return '"' + self.__json_number(k) + '"'
+
+    # get the JSON text of a raw value, None if the value is nil
+    def __json_value(self, typ, raw):
+        if typ == 'string':
+            return json.encoder.encode_basestring_ascii(
+                self.__eval_raw_string(raw))
+        elif typ == 'number':
+            try:
+                x = Utils.str_to_num(raw)
+            except:  # nil, as in __eval_expr()
+                return None
+            return self.__json_number(x)
+        elif typ == 'boolean':
+            return raw
+        return None
+
+    # format numbers like the json module does
+    def __json_number(self, x):
+        if not isinstance(x, float):
+            return str(x)
+        elif x != x:
+            return 'NaN'
+        elif x == float('inf'):
+            return 'Infinity'
+        elif x == -float('inf'):
+            return '-Infinity'
+        return repr(x)
+
+    # evaluate the raw text of a key reported by LuaTableReader.next_events()
+    def evalKey(self, raw):
+        return self.__eval_raw_key(raw)
+
+    # compile a LuaRecordSchema into a LuaRecordDecoder, whose decode() and
+    # decode_list() methods parse matching tables into record objects
+    def compileSchema(self, schema):
+        return LuaRecordDecoder(schema, self.__eval_raw_key,
+                                self.__eval_raw_value, self.__merge_result,
+                                self.__pooled)
+
     def __getitem__(self, item):
         if isinstance(self.__table, list):
             n = len(self.__table)
@@ -475,6 +1152,32 @@ class LuaTableParser:
         else:
             return self.__table[item]
 
+    def __setitem__(self, item, value):
+        if isinstance(self.__table, list):
+            n = len(self.__table)
+            if item < 1 or item > n:
+                raise IndexError('table index out of range')
+            else:
+                self.__table[item-1] = value
+        else:
+            self.__table[item] = value
+
+    # parse a string to a table, sharing strings within the load
+    def __load(self, s):
+        return self.__pooled(self.__parse, s)
+
+    # call fn(*args) as one load of the string pool; every method which
+    # evaluates keys or strings goes through here, so that the strings
+    # shared within a load are dropped when it ends
+    def __pooled(self, fn, *args):
+        if self.__pool is None:
+            return fn(*args)
+        self.__pool.begin()
+        try:
+            return fn(*args)
+        finally:
+            self.__pool.end()
+
     # parse a string to a table
     def __parse(self, s):
         reader = LuaTableReader(s)
@@ -493,15 +1196,18 @@ class LuaTableParser:
 
     def __merge_result(self, lst, dct):
         if len(dct) == 0:
-            return lst
+            ret = lst
         elif len(lst) == 0:
-            return dct
+            ret = dct
         else:
             l = len(lst)
             for i in range(l):
                 if lst[i] is not None:
                     dct[i+1] = lst[i]
-            return dct
+            ret = dct
+        if self.__tracking:
+            return Utils.track(ret, None)
+        return ret
 
     def __parse_field(self, field):
         expr_k, expr_v = field[0], field[1]
@@ -514,16 +1220,19 @@ class LuaTableParser:
         # the table index must be a string or a number
         n = len(index)
         if n > 1 and index.startswith('"') and index.endswith('"'):
-            return self.__eval_string(index[1:n-1])
+            key = self.__eval_string(index[1:n-1])
         elif n > 1 and index.startswith('\'') and index.endswith('\''):
-            return self.__eval_string(index[1:n-1])
+            key = self.__eval_string(index[1:n-1])
         else:
             try:
                 x = Utils.str_to_num(index)
             except:
-                return index
+                key = index
             else:
                 return x
+        if self.__pool is not None:
+            return self.__pool.intern(key)
+        return key
 
     def __eval_expr(self, expr):
         if expr == 'nil':
@@ -538,7 +1247,11 @@ class LuaTableParser:
             return self.__parse(expr)
         elif n > 1 and expr[0] in '\'\"' and expr[n-1] in '\'\"' \
             and expr[0] == expr[n-1]: # string
-            return self.__eval_string(expr[1:n - 1])
+            x = self.__eval_string(expr[1:n - 1])
+            if self.__pool is not None \
+                    and len(x) <= self.__pool.max_value_length:
+                return self.__pool.intern(x)
+            return x
         try:
             x = Utils.str_to_num(expr)
         except: # nil
@@ -547,6 +1260,8 @@ class LuaTableParser:
             return x
 
     def __eval_string(self, s):
+        if '\\' not in s:
+            return s
         ret = ''
         n, i = len(s), 0
         while i < n:
@@ -610,9 +1325,24 @@ class LuaTableParser:
         return self.__dump_aux(table, 4, 0)
 
     def __dump_aux(self, d, indent_factor, indent):
+        if isinstance(d, LuaDict):  # reuse the text of an unchanged table
+            cache = d.dump_cache
+            if cache is not None and cache[0] == indent_factor \
+                    and cache[1] == indent:
+                return cache[2]
+            ret = self.__dump_dict(d, indent_factor, indent)
+            d.dump_cache = (indent_factor, indent, ret)
+            return ret
+        return self.__dump_dict(d, indent_factor, indent)
+
+    def __dump_dict(self, d, indent_factor, indent):
         commanate = False
         length = len(d)
         keys = d.keys()
+        if 1 < length <= self.SHAPE_MAX_KEYS:
+            shape = self.__get_shape(keys, indent_factor, indent)
+            if shape is not None:
+                return self.__dump_shape(d, shape)
         ret = '{'
         if length == 1:
             key = keys[0]
@@ -641,11 +1371,76 @@ class LuaTableParser:
         ret += '}'
         return ret
 
+    # a shape is the key sequence of a dict together with its indentation;
+    # dicts of the same shape, like the records of a large array, share
+    # precomputed key prefixes and per-field value formatters. The shapes
+    # are kept in least recently used order, and the oldest one is dropped
+    # when there are more than SHAPE_CACHE_SIZE of them
+    def __get_shape(self, keys, indent_factor, indent):
+        sig = (tuple(keys), indent_factor, indent)
+        shapes = self.__shapes
+        shape = shapes.pop(sig, None)
+        if shape is None:
+            shape = self.__compile_shape(keys, indent_factor, indent)
+            if len(shapes) >= self.SHAPE_CACHE_SIZE:
+                shapes.popitem(False)
+        shapes[sig] = shape
+        return shape or None
+
+    # @return [fields, suffix, indent_factor, indent], where fields is a list
+    #         of [key, prefix, type, formatter]; the type and formatter are
+    #         taken from the first dict dumped with this shape
+    #         False if the shape has keys which are not strings, because
+    #         1 and 1.0 would share a signature but not their dumped index
+    def __compile_shape(self, keys, indent_factor, indent):
+        new_indent = indent + indent_factor
+        sep, suffix = '', '}'
+        if indent_factor > 0:
+            sep, suffix = '\n', '\n' + self.__indent(indent) + '}'
+        fields, delim = [], '{'
+        for key in keys:
+            if not isinstance(key, str):
+                return False
+            prefix = delim + sep + self.__indent(new_indent) \
+                + self.__dump_index(key) + '='
+            if indent_factor > 0:
+                prefix += ' '
+            fields.append([key, prefix, None, None])
+            delim = ','
+        return [fields, suffix, indent_factor, new_indent]
+
+    def __dump_shape(self, d, shape):
+        fields, suffix, indent_factor, indent = shape
+        ret = []
+        for field in fields:
+            v = d[field[0]]
+            if type(v) is not field[2]:
+                if field[2] is not None:  # the field changed its type
+                    ret.append(field[1]
+                               + self.__dump_value(v, indent_factor, indent))
+                    continue
+                field[2] = type(v)
+                field[3] = self.__value_formatter(v, indent_factor, indent)
+            ret.append(field[1] + field[3](v))
+        ret.append(suffix)
+        return ''.join(ret)
+
+    # get a function which dumps values of the same type as v
+    def __value_formatter(self, v, indent_factor, indent):
+        if isinstance(v, bool):
+            return lambda x: x and 'true' or 'false'
+        elif isinstance(v, (int, float)):
+            return str
+        elif isinstance(v, str):
+            return self.__dump_string
+        elif isinstance(v, list):
+            return self.__dump_list
+        elif isinstance(v, dict):
+            return lambda x: self.__dump_aux(x, indent_factor, indent)
+        return lambda x: self.__dump_value(x, indent_factor, indent)
+
     def __indent(self, indent):
-        ret = ''
-        for i in range(indent):
-            ret += ' '
-        return ret
+        return ' ' * indent
 
     def __dump_index(self, index):
         if isinstance(index, (int, float)):
@@ -672,12 +1467,27 @@ class LuaTableParser:
         return 'nil'
 
     def __dump_string(self, s):
+        if not self.__needs_escape(s):
+            return '\"' + s + '\"'
         ret = ''
         for c in s:
             ret += self.__dump_char(c)
         return '\"' + ret + '\"'
 
+    def __needs_escape(self, s):
+        for c in '\\\'\"[]\a\b\f\n\r\t\v':
+            if c in s:
+                return True
+        return False
+
     def __dump_list(self, lst):
+        if isinstance(lst, LuaList):
+            if lst.dump_cache is None:
+                lst.dump_cache = self.__dump_elements(lst)
+            return lst.dump_cache
+        return self.__dump_elements(lst)
+
+    def __dump_elements(self, lst):
         commanate = False
         ret = '{'
         for elem in lst:
@@ -687,3 +1497,603 @@ class LuaTableParser:
             commanate = True
         ret += '}'
         return ret
+
+
+# LuaDict and LuaList instances are the tables loaded by a LuaTableParser in
+# tracking mode. They cache the text they were last dumped to, and a change
+# drops the cache of the table and of all the tables containing it. Dicts and
+# lists stored into them are replaced by tracked copies, as is a tracked table
+# which already belongs to another table.
+class LuaDict(dict):
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.parent = None
+        self.dump_cache = None
+        self.update(*args, **kwargs)
+
+    # drop the dumped text of this table and of the tables containing it
+    def touch(self):
+        t = self
+        while t is not None:
+            t.dump_cache = None
+            t = t.parent
+
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, Utils.track(v, self))
+        self.touch()
+
+    def __delitem__(self, k):
+        dict.__delitem__(self, k)
+        self.touch()
+
+    def clear(self):
+        dict.clear(self)
+        self.touch()
+
+    def pop(self, *args):
+        ret = dict.pop(self, *args)
+        self.touch()
+        return ret
+
+    def popitem(self):
+        ret = dict.popitem(self)
+        self.touch()
+        return ret
+
+    def setdefault(self, k, v=None):
+        if k not in self:
+            self[k] = v
+        return self[k]
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+
+class LuaList(list):
+    def __init__(self, iterable=()):
+        list.__init__(self)
+        self.parent = None
+        self.dump_cache = None
+        self.extend(iterable)
+
+    # drop the dumped text of this table and of the tables containing it
+    def touch(self):
+        t = self
+        while t is not None:
+            t.dump_cache = None
+            t = t.parent
+
+    def __track_all(self, iterable):
+        return [Utils.track(v, self) for v in iterable]
+
+    def __setitem__(self, i, v):
+        if isinstance(i, slice):
+            list.__setitem__(self, i, self.__track_all(v))
+        else:
+            list.__setitem__(self, i, Utils.track(v, self))
+        self.touch()
+
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        self.touch()
+
+    # simple slices of lists still go through these methods in Python 2
+    def __setslice__(self, i, j, seq):
+        list.__setslice__(self, i, j, self.__track_all(seq))
+        self.touch()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self.touch()
+
+    def __iadd__(self, seq):
+        self.extend(seq)
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)  # the items would be shared, so copy them
+        list.__setslice__(self, 0, len(self), self.__track_all(list(self)))
+        self.touch()
+        return self
+
+    def append(self, v):
+        list.append(self, Utils.track(v, self))
+        self.touch()
+
+    def extend(self, seq):
+        list.extend(self, self.__track_all(seq))
+        self.touch()
+
+    def insert(self, i, v):
+        list.insert(self, i, Utils.track(v, self))
+        self.touch()
+
+    def pop(self, *args):
+        ret = list.pop(self, *args)
+        self.touch()
+        return ret
+
+    def remove(self, v):
+        list.remove(self, v)
+        self.touch()
+
+    def reverse(self):
+        list.reverse(self)
+        self.touch()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.touch()
+
+
+# LuaStringPool instances share identical strings between the tables built by
+# LuaTableParser; keys are always interned, string values only if they are
+# no longer than max_value_length. Strings are kept in a pool of at most
+# capacity entries, which lives across loads and can be shared by several
+# parsers; once the pool is full, new strings are only shared within a load
+class LuaStringPool:
+    def __init__(self, capacity=65536, max_value_length=0):
+        self.capacity = capacity
+        self.max_value_length = max_value_length
+        self.__pool = {}
+        self.__local = {}
+        self.__hits = 0
+        self.__misses = 0
+
+    # get the shared object equal to s
+    def intern(self, s):
+        x = self.__pool.get(s)
+        if x is None:
+            x = self.__local.get(s)
+        if x is not None:
+            self.__hits += 1
+            return x
+        self.__misses += 1
+        if isinstance(s, str):
+            s = intern(s)  # makes lookups with literal keys faster
+        if len(self.__pool) < self.capacity:
+            self.__pool[s] = s
+        else:
+            self.__local[s] = s
+        return s
+
+    # called by LuaTableParser when a load starts or ends
+    def begin(self):
+        self.__local = {}
+
+    def end(self):
+        self.__local = {}
+
+    def clear(self):
+        self.__pool, self.__local = {}, {}
+        self.__hits, self.__misses = 0, 0
+
+    # @return a dict with the number of hits and misses, the hit rate,
+    #         and the size and capacity of the pool
+    def stats(self):
+        total = self.__hits + self.__misses
+        hit_rate = 0.0
+        if total > 0:
+            hit_rate = float(self.__hits) / total
+        return {'hits': self.__hits, 'misses': self.__misses,
+                'hit_rate': hit_rate, 'size': len(self.__pool),
+                'capacity': self.capacity}
+
+
+# LuaRecordSchema instances describe homogeneous record tables such as
+# {x=0, y=0}; pass them to LuaTableParser.compileSchema() to get a decoder
+class LuaRecordSchema:
+    # name : the name of the generated record class
+    # fields : a list of (name, type) or (name, type, default) tuples, where
+    #          type is int, float, str, bool, list, dict, None (any value)
+    #          or another LuaRecordSchema; fields without a default are
+    #          required
+    # kind : 'slots' for classes with __slots__, 'namedtuple' for namedtuples
+    def __init__(self, name, fields, kind='slots'):
+        if kind not in ('slots', 'namedtuple'):
+            raise Exception('unknown record kind : ' + str(kind))
+        self.name = name
+        self.kind = kind
+        self.names, self.types, self.defaults = [], [], []
+        for field in fields:
+            if len(field) not in (2, 3):
+                raise Exception('invalid field declaration : ' + str(field))
+            if field[0] in self.names:
+                raise Exception('duplicate field : ' + field[0])
+            self.names.append(field[0])
+            self.types.append(field[1])
+            if len(field) == 3:
+                self.defaults.append(field[2])
+            else:
+                self.defaults.append(Utils.MISSING)
+        if kind == 'namedtuple':
+            self.record_type = collections.namedtuple(name, self.names)
+        else:
+            self.record_type = Utils.make_record_class(name, self.names)
+
+
+# LuaRecordDecoder instances parse tables matching a LuaRecordSchema straight
+# into record objects, in one pass over the events of LuaTableReader, without
+# building an intermediate dict for each table
+class LuaRecordDecoder:
+    def __init__(self, schema, eval_key, eval_value, merge_result, pooled):
+        self.__schema = schema
+        self.__pooled = pooled
+        self.__eval_key = eval_key
+        self.__eval_value = eval_value
+        self.__merge_result = merge_result
+        self.__record_type = schema.record_type
+        self.__defaults = schema.defaults
+        self.__required = []
+        self.__names, self.__slots = {}, {}
+        n = len(schema.names)
+        for i in range(n):
+            name = schema.names[i]
+            if schema.defaults[i] is Utils.MISSING:
+                self.__required.append(i)
+            slot = (i, self.__converter(name, schema.types[i]))
+            self.__names[name] = slot
+            # the reader hands out keys as they appear in the text, so
+            # x = ..., ["x"] = ... and ['x'] = ... are matched without
+            # evaluation
+            self.__slots[name] = slot
+            self.__slots['"' + name + '"'] = slot
+            self.__slots['\'' + name + '\''] = slot
+
+    # decode a single record from a string
+    def decode(self, s):
+        return self.__pooled(self.__decode, s)
+
+    def __decode(self, s):
+        events = LuaTableReader(s).next_events(True, False)
+        events.next()  # the start of the record
+        return self.__decode_events(events)
+
+    # decode the array part of a table whose elements are records, e.g.
+    # {{x=0, y=0}, {x=1, y=0}}; nil elements are decoded as None and
+    # the named fields of the outer table are ignored
+    def decode_list(self, s):
+        return self.__pooled(self.__decode_list, s)
+
+    def __decode_list(self, s):
+        events = LuaTableReader(s).next_events(True, False)
+        events.next()  # the start of the outer table
+        ret, key = [], None
+        for event in events:
+            kind = event[0]
+            if kind == 'key':
+                key = event[1]
+                continue
+            elif kind == 'start_table':
+                if key is None:
+                    ret.append(self.__decode_events(events))
+                else:
+                    self.__skip_table(events)
+            elif kind == 'value' and key is None:
+                ret.append(self.__decode_value(event))
+            key = None
+        return ret
+
+    # decode a nested record from the event after its key
+    def __decode_value(self, event):
+        if event[1] == 'nil':
+            return None
+        raise Exception('record ' + self.__schema.name
+                        + ' must be a table, got ' + event[2])
+
+    # decode the fields of a record whose start_table event has been read,
+    # up to its end_table event
+    def __decode_events(self, events):
+        values, key = list(self.__defaults), None
+        for event in events:
+            kind = event[0]
+            if kind == 'end_table':
+                break
+            elif kind == 'key':
+                key = event[1]
+                continue
+            elif key is None:
+                raise Exception('unexpected positional field \"'
+                                + self.__event_text(event)
+                                + '\" in record ' + self.__schema.name)
+            slot = self.__slots.get(key)
+            if slot is None:
+                k = self.__eval_key(key)
+                slot = self.__names.get(k)
+                if slot is None:
+                    raise Exception('unknown field \"' + str(k)
+                                    + '\" in record ' + self.__schema.name)
+            i, convert = slot
+            v = convert(events, event)
+            if v is not None:
+                values[i] = v
+            key = None
+        for i in self.__required:
+            if values[i] is Utils.MISSING:
+                raise Exception('missing field \"' + self.__schema.names[i]
+                                + '\" in record ' + self.__schema.name)
+        return self.__record_type(*values)
+
+    # build the value of a table whose start_table event has been read,
+    # as LuaTableParser.load() does
+    def __build_table(self, events):
+        lst, dct, key = [], {}, None
+        for event in events:
+            kind = event[0]
+            if kind == 'end_table':
+                break
+            elif kind == 'key':
+                key = event[1]
+                continue
+            elif kind == 'start_table':
+                v = self.__build_table(events)
+            else:
+                v = self.__eval_value(event[1], event[2])
+            if key is None:
+                lst.append(v)
+            elif v is not None:
+                dct[self.__eval_key(key)] = v
+            key = None
+        return self.__merge_result(lst, dct)
+
+    def __skip_table(self, events):
+        depth = 1
+        for event in events:
+            if event[0] == 'start_table':
+                depth += 1
+            elif event[0] == 'end_table':
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def __event_text(self, event):
+        if event[0] == 'start_table':
+            return '{...}'
+        return event[2]
+
+    # build a function which evaluates and type-checks the value of a field,
+    # given the events and the value or start_table event of the field;
+    # a nil value evaluates to None, leaving the default in place
+    def __converter(self, name, typ):
+        eval_value = self.__eval_value
+        event_text = self.__event_text
+
+        def fail(event):
+            raise Exception('field \"' + name + '\" of record '
+                            + self.__schema.name + ' expects '
+                            + self.__type_name(typ) + ', got '
+                            + event_text(event))
+
+        if isinstance(typ, LuaRecordSchema):
+            decoder = LuaRecordDecoder(typ, self.__eval_key, eval_value,
+                                       self.__merge_result, self.__pooled)
+
+            def convert(events, event):
+                if event[0] == 'start_table':
+                    return decoder.__decode_events(events)
+                return decoder.__decode_value(event)
+        elif typ is bool:
+            def convert(events, event):
+                if event[0] == 'value' and event[1] == 'boolean':
+                    return event[2] == 'true'
+                elif event[0] == 'value' and event[1] == 'nil':
+                    return None
+                fail(event)
+        elif typ in (int, float):
+            def convert(events, event):
+                if event[0] == 'value' and event[1] == 'nil':
+                    return None
+                elif event[0] != 'value' or event[1] != 'number':
+                    fail(event)
+                x = eval_value(event[1], event[2])
+                if x is None:  # not a valid number
+                    fail(event)
+                elif typ is float:
+                    return float(x)
+                elif not isinstance(x, (int, long)):
+                    fail(event)
+                return x
+        elif typ is str:
+            def convert(events, event):
+                if event[0] == 'value' and event[1] == 'nil':
+                    return None
+                elif event[0] != 'value' or event[1] != 'string':
+                    fail(event)
+                return eval_value(event[1], event[2])
+        elif typ in (list, dict):
+            def convert(events, event):
+                if event[0] == 'value' and event[1] == 'nil':
+                    return None
+                elif event[0] != 'start_table':
+                    fail(event)
+                x = self.__build_table(events)
+                if typ is dict and x == []:  # an empty table
+                    return {}
+                elif not isinstance(x, typ):
+                    fail(event)
+                return x
+        elif typ is None:
+            def convert(events, event):
+                if event[0] == 'start_table':
+                    return self.__build_table(events)
+                return eval_value(event[1], event[2])
+        else:
+            raise Exception('unsupported field type : ' + str(typ))
+        return convert
+
+    def __type_name(self, typ):
+        if isinstance(typ, LuaRecordSchema):
+            return typ.name
+        return typ.__name__
+
+
+# LuaTableIndex instances give random access to a large file of lua tables.
+# The file is scanned once, and the offset and length of each top-level field
+# (or of each table, in files holding several tables like test4.txt, where
+# lines starting with '#' are skipped) are kept in an index file. Lookups
+# then parse only their own slice of the file. The index is rebuilt when the
+# size or modification time of the file changes.
+class LuaTableIndex:
+    VERSION = 1
+
+    # p : the path of the file of lua tables
+    # index_path : the path of the index file, p + '.idx' by default
+    def __init__(self, p, index_path=None):
+        self.__path = p
+        self.__index_path = index_path or p + '.idx'
+        self.__parser = LuaTableParser()
+        self.__index = None
+        self.__check()
+
+    # get the value of the top-level field with the given key
+    def get(self, key):
+        self.__check()
+        if self.__index['multi']:
+            raise Exception('a file of several tables has no keys, '
+                            + 'use get_nth() instead')
+        return self.__get_span(self.__index['keys'][key])
+
+    # get the n-th table of a file of several tables, or the n-th value in
+    # the array part of a single table; n starts from 1
+    def get_nth(self, n):
+        self.__check()
+        nth = self.__index['nth']
+        if n < 1 or n > len(nth):
+            raise IndexError('table index out of range')
+        return self.__get_span(nth[n-1])
+
+    def keys(self):
+        self.__check()
+        return self.__index['keys'].keys()
+
+    def __len__(self):
+        self.__check()
+        return len(self.__index['nth'])
+
+    def __get_span(self, i):
+        offsets, lengths = self.__index['offsets'], self.__index['lengths']
+        f = open(self.__path, 'rb')
+        f.seek(offsets[i])
+        text = f.read(lengths[i])
+        f.close()
+        # wrap the slice, so that scalars and tables are parsed alike
+        self.__parser.load('{' + text + '}')
+        return self.__parser[1]
+
+    # make sure the index is up to date with the file
+    def __check(self):
+        st = os.stat(self.__path)
+        if self.__index is None:
+            self.__index = self.__read_index()
+        if self.__index is None or self.__index['size'] != st.st_size \
+                or self.__index['mtime'] != st.st_mtime:
+            self.__index = self.__build_index(st)
+            f = open(self.__index_path, 'wb')
+            marshal.dump(self.__index, f)
+            f.close()
+        if not isinstance(self.__index['offsets'], array.array):
+            for name in ('offsets', 'lengths', 'nth'):
+                a = array.array('L')
+                a.fromstring(self.__index[name])
+                self.__index[name] = a
+
+    def __read_index(self):
+        try:
+            f = open(self.__index_path, 'rb')
+        except IOError:
+            return None
+        try:
+            index = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            index = None
+        f.close()
+        if not isinstance(index, dict) or index.get('version') != self.VERSION:
+            return None
+        return index
+
+    # the index is a dict holding the 'size' and 'mtime' of the file, the
+    # 'offsets' and 'lengths' of the spans, the 'keys' of the spans of the
+    # top-level fields and the spans in 'nth' order; the arrays are stored
+    # as strings
+    def __build_index(self, st):
+        offsets, lengths = array.array('L'), array.array('L')
+        keys, nth, tables = {}, array.array('L'), 0
+        f = open(self.__path, 'rb')
+        text = ''
+        if st.st_size > 0:
+            text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        reader = LuaTableReader(text)
+        while True:
+            c = reader.next_clean()
+            if c is None:
+                break
+            reader.back()
+            if c == '#':  # a line which is not a part of any table
+                end = text.find('\n', reader.tell())
+                if end == -1:
+                    end = len(text)
+                reader.seek(end)
+                continue
+            start = reader.tell()
+            if tables == 0:
+                self.__index_fields(reader, offsets, lengths, keys, nth)
+            else:
+                for _ in reader.next_events(False, False):
+                    pass
+            offsets.append(start)
+            lengths.append(reader.tell() - start)
+            tables += 1
+        if isinstance(text, mmap.mmap):
+            text.close()
+        f.close()
+        if tables == 0:
+            raise Exception('no lua table found in ' + self.__path)
+
+        if tables > 1:  # only keep the spans of the tables
+            n = len(offsets) - tables
+            offsets, lengths = offsets[n:], lengths[n:]
+            keys, nth = {}, array.array('L', range(tables))
+        return {'version': self.VERSION, 'size': st.st_size,
+                'mtime': st.st_mtime, 'multi': tables > 1,
+                'offsets': offsets.tostring(), 'lengths': lengths.tostring(),
+                'keys': keys, 'nth': nth.tostring()}
+
+    # record the span of each top-level field of the table at the reader;
+    # keys get the same values as in __merge_result(), so nil fields are
+    # left out and the array part takes precedence over integer keys
+    def __index_fields(self, reader, offsets, lengths, keys, nth):
+        depth, key, start, array_part = 0, None, 0, []
+        for event in reader.next_events(True, False):
+            kind = event[0]
+            if kind == 'start_table':
+                depth += 1
+                if depth == 2:
+                    start = reader.tell() - 1
+                continue
+            elif kind == 'key':
+                if depth == 1:
+                    key = event[1]
+                continue
+            elif kind == 'end_table':
+                depth -= 1
+                if depth != 1:
+                    continue
+                nil = False
+            elif depth != 1:
+                continue
+            else:
+                start = reader.tell() - len(event[2])
+                nil = event[1] == 'nil'
+            i = len(offsets)
+            offsets.append(start)
+            lengths.append(reader.tell() - start)
+            if key is None:
+                nth.append(i)
+                array_part.append(None if nil else i)
+            elif not nil:
+                keys[self.__parser.evalKey(key)] = i
+            key = None
+        for n in range(len(array_part)):
+            if array_part[n] is not None:
+                keys[n+1] = array_part[n]
@@ -137,3 +137,155 @@ test4()
 
 
 
+
+
+def test5():
+    print '.................... Test5 compileSchema'
+    p = LuaTableParser()
+    point = LuaRecordSchema('Point', [('x', int), ('y', int), ('label', str, '')])
+    decoder = p.compileSchema(point)
+    print decoder.decode('{x=1, ["y"]=2, label="a"}')
+    s = '{color="blue", thickness=2, npoints=4,\
+                 {x=0,   y=0},\
+                 {x=-10, y=0},\
+                 {x=-10, y=1},\
+                 {x=0,   y=1}\
+          }'
+    print decoder.decode_list(s)
+
+    line = LuaRecordSchema('Line', [('a', point), ('b', point),
+                                    ('width', float, 1.0)], kind='namedtuple')
+    print p.compileSchema(line).decode('{a={x=0, y=0}, b={x=3, y=4}, width=2}')
+
+    for bad in ['{x=1}', '{x=1, y=2, z=3}', '{x=1, y="2"}', '{1, 2}']:
+        try:
+            decoder.decode(bad)
+        except Exception as e:
+            print '... ' + bad + ' : ' + str(e)
+
+test5()
+
+
+def test6():
+    print '.................... Test6 dump tables of the same shape'
+    p = LuaTableParser()
+    p.load('{a={x=0, y=0, name="a"}, b={x=1, y=2.5, name="b\\n"},\
+             c={x=1, y=false, name=nil}, {x=0, y=0}, {x=1, y=1}}')
+    print p.dump()
+    print p.dump()
+
+test6()
+
+
+def test7():
+    print '.................... Test7 LuaStringPool'
+    pool = LuaStringPool(capacity=4, max_value_length=8)
+    p = LuaTableParser(pool)
+    p.load('{{x=0, y=0, color="blue"}, {x=1, ["y"]=1, color="blue"}}')
+    print p[1]['color'] is p[2]['color'], p[1].keys()[0] is p[2].keys()[0]
+    print sorted(pool.stats().items())
+    p.load('{x=2, y=3, color="red", name="a long name"}')
+    print p.dump()
+    print sorted(pool.stats().items())
+
+test7()
+
+
+def test8():
+    print '.................... Test8 parseEvents'
+    p = LuaTableParser()
+    s = '{x=1, ["y"]=2.5, [3]=\'z\' --[[c]], {true, nil}, [[xs]], name; w=v, n=inf}'
+    for event in p.parseEvents(s):
+        print event
+
+    class Counter:
+        def __init__(self):
+            self.tables, self.comments = 0, []
+
+        def start_table(self):
+            self.tables += 1
+
+        def comment(self, text):
+            self.comments.append(text)
+
+    f = open('test2-load.txt', 'r')
+    counter = Counter()
+    p.parseEvents(f.read(), counter)
+    f.close()
+    print counter.tables, counter.comments
+
+test8()
+
+
+def test9():
+    print '.................... Test9 loadColumns'
+    p = LuaTableParser()
+    s = '{color="blue", thickness=2, npoints=4,\
+                 {x=0,   y=0},\
+                 {x=-10, y=0.5, label="a"},\
+                 nil,\
+                 {x=-10, y=1, ["label"]=[[b]]},\
+                 {x=0,   y=1, label=nil}\
+          }'
+    columns, valid = p.loadColumns(s)
+    for k in sorted(columns.keys()):
+        print k, columns[k], valid[k]
+
+test9()
+
+
+def test10():
+    print '.................... Test10 tracking mode'
+    p = LuaTableParser(tracking=True)
+    p.loadLuaTable('test2-load.txt')
+    s = p.dump()
+    print s == p.dump()
+    p['dict']['mixed'][1] = 44
+    p['dict']['array'].append({'x': 0, 'y': 0})
+    p['dict']['array'][3]['x'] = 1
+    p['game'] = 'sad'
+    print p.dump()
+
+    q = LuaTableParser()
+    q.load(p.dump())
+    print q.dumpDict() == p.dumpDict()
+    del p['dict']['mixed']
+    q.load(p.dump())
+    print q.dumpDict() == p.dumpDict()
+
+test10()
+
+
+def test11():
+    print '.................... Test11 transcodeJSON'
+    import StringIO
+    p = LuaTableParser()
+    for s in ['{}', '{1, nil, "two", {x=1, y=nil}}', '{x=nil, y = 0, z=nil, nil}',
+              '{"x", [1]=1, [2]=2; [2.5]="\\n", [ [[a\\b]] ]=true}']:
+        out = StringIO.StringIO()
+        p.transcodeJSON(s, out)
+        print out.getvalue()
+
+    p.transcodeLuaTable('test2-load.txt', 'test2-dump.json')
+    f = open('test2-dump.json', 'r')
+    print f.read()
+    f.close()
+
+test11()
+
+
+def test12():
+    print '.................... Test12 LuaTableIndex'
+    index = LuaTableIndex('test4.txt')
+    print len(index), index.get_nth(1), index.get_nth(6), index.get_nth(len(index))
+
+    index = LuaTableIndex('test2-load.txt')
+    print sorted(index.keys())
+    print index.get('array'), index.get('dict')['string']
+    index = LuaTableIndex('test2-load.txt')  # read from the index file
+    print index.get('dict')
+
+    index = LuaTableIndex('test12.txt')  # {true, false} with spaces
+    print index.get_nth(1), index.get_nth(2), index.get(1), index.get(2)
+
+test12()